@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 """Telegram UID Manager Bot (SQLite, admin controls, auto-detect FB links, bilingual menu)"""
 import os
+import asyncio
 import re
-import sqlite3
 import csv
 import io
+import tempfile
 import datetime
+import itertools
+import time
 import logging
+from collections import OrderedDict
 from functools import wraps
 
 from dotenv import load_dotenv
@@ -16,12 +20,16 @@ from telegram.ext import (
     CallbackQueryHandler
 )
 import aiohttp
+import aiosqlite
+from aiosqlitepool import SQLiteConnectionPool
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 FB_ACCESS_TOKEN = os.getenv("FB_ACCESS_TOKEN")  # optional
-ADMINS = [int(x.strip()) for x in os.getenv("ADMINS", "").split(",") if x.strip().isdigit()]
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")  # optional: public host for webhook mode, else long-polling
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+ADMINS = frozenset(int(x.strip()) for x in os.getenv("ADMINS", "").split(",") if x.strip().isdigit())
 
 if not TELEGRAM_TOKEN:
     raise RuntimeError("Set TELEGRAM_TOKEN in env or .env file")
@@ -29,35 +37,110 @@ if not TELEGRAM_TOKEN:
 logging.basicConfig(level=logging.INFO)
 DB_PATH = "uids.db"
 
+_FB_URL_RE = re.compile(r"https?://(?:www\.)?facebook\.com/[^\s]+")
+_FB_UID_RE = re.compile(r"facebook\.com/(?:profile\.php\?id=)?([0-9A-Za-z.\-_]+)")
+MAX_SCAN_CHARS = 10_000  # longer messages are only scanned up to here
+MAX_URLS_PER_MESSAGE = 20
+FB_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3, sock_read=8)
+
 # --- DB helper ---
-def with_db(func):
+async def _connect_db():
+    conn = await aiosqlite.connect(DB_PATH)
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+POOL = SQLiteConnectionPool(_connect_db, pool_size=8)
+
+def with_db(func=None, *, batch=False):
+    """Inject a pooled `conn` and commit on success.
+
+    With batch=True the call runs inside BEGIN IMMEDIATE, so every write it makes
+    lands in one transaction (one fsync) with the write lock taken up front.
+    """
+    if func is None:
+        return lambda f: with_db(f, batch=batch)
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        try:
+        if 'conn' in kwargs:
+            # called from another @with_db function: reuse its connection/transaction
+            return await func(*args, **kwargs)
+        async with POOL.connection() as conn:
+            if batch:
+                await conn.execute("BEGIN IMMEDIATE")
             result = await func(*args, conn=conn, **kwargs)
-            conn.commit()
+            await conn.commit()
             return result
-        finally:
-            conn.close()
     return wrapper
 
+# saved_at holds Unix epoch seconds (UTC)
+UIDS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS {} (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL,
+    note TEXT,
+    chat_id INTEGER,
+    saved_at INTEGER NOT NULL
+)"""
+
+async def _migrate_saved_at(conn):
+    """Convert a legacy uids table with ISO-text saved_at to integer epoch seconds."""
+    cur = await conn.execute("SELECT type FROM pragma_table_info('uids') WHERE name = 'saved_at'")
+    r = await cur.fetchone()
+    if r is None or r[0].upper() == 'INTEGER':
+        return
+    # a TEXT column would coerce the integers straight back to text, so rebuild the table
+    await conn.execute(UIDS_TABLE_SQL.format("uids_new"))
+    await conn.execute("INSERT INTO uids_new (id, uid, note, chat_id, saved_at) "
+                       "SELECT id, uid, note, chat_id, COALESCE(CAST(strftime('%s', saved_at) AS INTEGER), 0) FROM uids")
+    await conn.execute("DROP TABLE uids")
+    await conn.execute("ALTER TABLE uids_new RENAME TO uids")
+
 @with_db
 async def init_db(*, conn):
-    cur = conn.cursor()
-    cur.execute("""CREATE TABLE IF NOT EXISTS uids (
-        id INTEGER PRIMARY KEY,
-        uid TEXT NOT NULL,
-        note TEXT,
-        chat_id INTEGER,
-        saved_at TEXT
+    await conn.execute(UIDS_TABLE_SQL.format("uids"))
+    await _migrate_saved_at(conn)
+    await conn.execute("CREATE INDEX IF NOT EXISTS ix_uids_chat_uid ON uids(chat_id, uid)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS ix_uids_chat_saved ON uids(chat_id, saved_at)")
+    # trigram FTS index over uid/note for /find, kept in sync with uids by triggers
+    cur = await conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'uids_fts'")
+    fts_exists = await cur.fetchone() is not None
+    await conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS uids_fts USING fts5(
+        uid, note, content='uids', content_rowid='id', tokenize='trigram'
     )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS settings (
+    await conn.execute("""CREATE TRIGGER IF NOT EXISTS uids_ai AFTER INSERT ON uids BEGIN
+        INSERT INTO uids_fts(rowid, uid, note) VALUES (new.id, new.uid, new.note);
+    END""")
+    await conn.execute("""CREATE TRIGGER IF NOT EXISTS uids_ad AFTER DELETE ON uids BEGIN
+        INSERT INTO uids_fts(uids_fts, rowid, uid, note) VALUES ('delete', old.id, old.uid, old.note);
+    END""")
+    await conn.execute("""CREATE TRIGGER IF NOT EXISTS uids_au AFTER UPDATE ON uids BEGIN
+        INSERT INTO uids_fts(uids_fts, rowid, uid, note) VALUES ('delete', old.id, old.uid, old.note);
+        INSERT INTO uids_fts(rowid, uid, note) VALUES (new.id, new.uid, new.note);
+    END""")
+    if not fts_exists:
+        # index rows saved before the FTS table existed
+        await conn.execute("INSERT INTO uids_fts(uids_fts) VALUES ('rebuild')")
+    await conn.execute("""CREATE TABLE IF NOT EXISTS settings (
         chat_id INTEGER PRIMARY KEY,
         notification_text TEXT
     )""")
-    conn.commit()
+
+# --- queries (shared constants, so pooled connections reuse their cached prepared statements) ---
+SQL_INSERT_UID = "INSERT INTO uids (uid, note, chat_id, saved_at) VALUES (?, ?, ?, ?)"
+# CROSS JOIN pins uids_fts as the outer loop: without ANALYZE stats the planner otherwise walks
+# every row of the chat and re-runs the MATCH per row (seconds on large tables)
+SQL_FIND_FTS = ("SELECT u.uid, u.note, u.saved_at FROM uids_fts CROSS JOIN uids u ON u.id = uids_fts.rowid "
+                "WHERE uids_fts MATCH ? AND u.chat_id = ? LIMIT 50")
+SQL_FIND_LIKE = "SELECT uid, note, saved_at FROM uids WHERE chat_id = ? AND (uid LIKE ? OR note LIKE ?) LIMIT 50"
+SQL_CHECK = "SELECT EXISTS(SELECT 1 FROM uids WHERE chat_id = ? AND uid = ?)"
+SQL_DELETE = "DELETE FROM uids WHERE chat_id = ? AND uid = ?"
+SQL_DELETE_ALL = "DELETE FROM uids WHERE chat_id = ?"
+SQL_EXPORT = "SELECT uid, note, strftime('%Y-%m-%dT%H:%M:%S', saved_at, 'unixepoch') FROM uids WHERE chat_id = ?"
+# MAX() in its own subquery so it is answered from the tail of ix_uids_chat_saved
+SQL_THONGKE = ("SELECT COUNT(*), (SELECT MAX(saved_at) FROM uids WHERE chat_id = ?) "
+               "FROM uids WHERE chat_id = ?")
 
 # --- utilities ---
 def admin_only(func):
@@ -70,22 +153,43 @@ def admin_only(func):
         return await func(update, context, *a, **k)
     return wrapper
 
-async def try_get_fb_uid_from_url(url: str):
+def ttl_cache(maxsize=4096, ttl=600):
+    """Cache an async function's non-None results by positional args for `ttl` seconds (LRU-bounded)."""
+    def decorator(func):
+        cache = OrderedDict()
+        @wraps(func)
+        async def wrapper(*args):
+            now = time.monotonic()
+            hit = cache.get(args)
+            if hit is not None and hit[0] > now:
+                cache.move_to_end(args)
+                return hit[1]
+            result = await func(*args)
+            if result is not None:  # don't pin failed lookups
+                cache[args] = (now + ttl, result)
+                cache.move_to_end(args)
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+        return wrapper
+    return decorator
+
+@ttl_cache()
+async def try_get_fb_uid_from_url(url: str, sess: aiohttp.ClientSession):
     """Try to extract UID from a Facebook URL. If FB_ACCESS_TOKEN is provided, use Graph API."""
     if not FB_ACCESS_TOKEN:
-        match = re.search(r"facebook\.com/(?:profile\.php\?id=)?([0-9A-Za-z.\-_]+)", url)
+        match = _FB_UID_RE.search(url)
         if match:
             return match.group(1)
         return None
     base = "https://graph.facebook.com/v17.0/"
-    async with aiohttp.ClientSession() as sess:
-        try:
-            async with sess.get(base, params={"id": url, "access_token": FB_ACCESS_TOKEN}, timeout=10) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data.get("id")
-        except Exception as e:
-            logging.warning(f"Graph fetch failed: {e}")
+    try:
+        async with sess.get(base, params={"id": url, "access_token": FB_ACCESS_TOKEN}, timeout=FB_TIMEOUT) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                return data.get("id")
+    except Exception as e:
+        logging.warning(f"Graph fetch failed: {e}")
     return None
 
 # --- conversation states ---
@@ -93,12 +197,14 @@ SAVE_SINGLE, SAVE_LIST, EDIT_NOTIFICATION, CHECKLIST = range(4)
 
 @with_db
 async def save_uid_to_db(chat_id, uid, note, *, conn):
-    cur = conn.cursor()
-    cur.execute("INSERT INTO uids (uid, note, chat_id, saved_at) VALUES (?, ?, ?, ?)",
-                (uid, note, chat_id, datetime.datetime.utcnow().isoformat()))
+    await conn.execute(SQL_INSERT_UID, (uid, note, chat_id, int(time.time())))
+
+@with_db(batch=True)
+async def save_uids_to_db(rows, *, conn):
+    """Insert many (uid, note, chat_id, saved_at) rows in one transaction."""
+    await conn.executemany(SQL_INSERT_UID, rows)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await init_db()
     kb = [
         [InlineKeyboardButton("📥 Lưu UID / Save UID", callback_data="menu_save") , InlineKeyboardButton("📤 Xuất CSV / Export CSV", callback_data="menu_export")],
         [InlineKeyboardButton("🔎 Tìm UID / Find UID", callback_data="menu_find"), InlineKeyboardButton("🗑️ Xoá UID / Delete UID", callback_data="menu_delete")],
@@ -149,14 +255,19 @@ async def cmd_find(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn):
         await update.message.reply_text("Dùng: /find <chuỗi> / Use: /find <text>")
         return
     q = " ".join(args)
-    cur = conn.cursor()
-    cur.execute("SELECT uid, note, saved_at FROM uids WHERE chat_id = ? AND (uid LIKE ? OR note LIKE ?) LIMIT 50",
-                (update.effective_chat.id, f"%{q}%", f"%{q}%"))
-    rows = cur.fetchall()
+    if len(q) >= 3:
+        # trigram phrase query == case-insensitive substring match, served from uids_fts
+        phrase = '"' + q.replace('"', '""') + '"'
+        cur = await conn.execute(SQL_FIND_FTS, (phrase, update.effective_chat.id))
+    else:
+        # shorter than one trigram: the FTS index can't help
+        cur = await conn.execute(SQL_FIND_LIKE, (update.effective_chat.id, f"%{q}%", f"%{q}%"))
+    rows = await cur.fetchall()
     if not rows:
         await update.message.reply_text("Không tìm thấy / No results.")
         return
-    out = "\n".join([f"{r['uid']} — {r['note'] or '-'} (saved:{r['saved_at'][:19]})" for r in rows])
+    _fmt = datetime.datetime.utcfromtimestamp
+    out = "\n".join([f"{uid} — {note or '-'} (saved:{_fmt(saved_at):%Y-%m-%d %H:%M:%S})" for uid, note, saved_at in rows])
     await update.message.reply_text(out)
 
 @with_db
@@ -166,10 +277,9 @@ async def cmd_check(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn)
         await update.message.reply_text("Dùng: /check <uid> / Use: /check <uid>")
         return
     uid = args[0]
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as c FROM uids WHERE chat_id = ? AND uid = ?", (update.effective_chat.id, uid))
-    r = cur.fetchone()
-    await update.message.reply_text("Đã có / Exists." if r['c']>0 else "Chưa có / Not found.")
+    cur = await conn.execute(SQL_CHECK, (update.effective_chat.id, uid))
+    (exists,) = await cur.fetchone()
+    await update.message.reply_text("Đã có / Exists." if exists else "Chưa có / Not found.")
 
 @with_db
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn):
@@ -178,43 +288,43 @@ async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn
         await update.message.reply_text("Dùng: /delete <uid> / Use: /delete <uid>")
         return
     uid = args[0]
-    cur = conn.cursor()
-    cur.execute("DELETE FROM uids WHERE chat_id = ? AND uid = ?", (update.effective_chat.id, uid))
+    cur = await conn.execute(SQL_DELETE, (update.effective_chat.id, uid))
     await update.message.reply_text("Đã xóa / Deleted." if cur.rowcount>0 else "Không tìm thấy UID / Not found.")
 
 @admin_only
 @with_db
 async def cmd_deleteall(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn):
-    cur = conn.cursor()
-    cur.execute("DELETE FROM uids WHERE chat_id = ?", (update.effective_chat.id,))
+    await conn.execute(SQL_DELETE_ALL, (update.effective_chat.id,))
     await update.message.reply_text("Đã xoá tất cả UID trong chat / All UIDs removed.")
 
 @admin_only
 @with_db
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn):
-    cur = conn.cursor()
-    cur.execute("SELECT uid, note, saved_at FROM uids WHERE chat_id = ?", (update.effective_chat.id,))
-    rows = cur.fetchall()
-    if not rows:
-        await update.message.reply_text("Không có UID / No UIDs.")
-        return
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["uid","note","saved_at"])
-    for r in rows:
-        writer.writerow([r['uid'], r['note'], r['saved_at']])
-    output.seek(0)
-    bio = io.BytesIO(output.read().encode('utf-8'))
-    bio.name = f"uids_{update.effective_chat.id}.csv"
-    await update.message.reply_document(InputFile(bio, filename=bio.name))
+    # rows are streamed from the cursor into a spooled temp file (spills to disk past 1 MB)
+    with tempfile.SpooledTemporaryFile(max_size=1_000_000, mode='w+b') as spool:
+        wrapper = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+        writer = csv.writer(wrapper)
+        writer.writerow(["uid","note","saved_at"])
+        count = 0
+        async with conn.execute(SQL_EXPORT, (update.effective_chat.id,)) as cur:
+            async for row in cur:
+                writer.writerow(row)
+                count += 1
+        wrapper.flush()
+        wrapper.detach()  # keep spool open when the wrapper is collected
+        if not count:
+            await update.message.reply_text("Không có UID / No UIDs.")
+            return
+        spool.seek(0)
+        await update.message.reply_document(InputFile(spool, filename=f"uids_{update.effective_chat.id}.csv"))
 
 @admin_only
 @with_db
 async def cmd_thongke(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn):
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as c, MAX(saved_at) as last FROM uids WHERE chat_id = ?", (update.effective_chat.id,))
-    r = cur.fetchone()
-    await update.message.reply_text(f"Tổng UID / Total UIDs: {r['c'] or 0}\nLưu gần nhất / Last saved: {r['last'] or '-'}")
+    cur = await conn.execute(SQL_THONGKE, (update.effective_chat.id, update.effective_chat.id))
+    total, last = await cur.fetchone()
+    last = datetime.datetime.utcfromtimestamp(last).isoformat(timespec='seconds') if last is not None else '-'
+    await update.message.reply_text(f"Tổng UID / Total UIDs: {total or 0}\nLưu gần nhất / Last saved: {last}")
 
 async def cmd_getid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Chat id: {update.effective_chat.id}\nUser id: {update.effective_user.id}")
@@ -239,34 +349,39 @@ async def handle_save_single(update: Update, context: ContextTypes.DEFAULT_TYPE,
     return ConversationHandler.END
 
 # --- detect FB link and auto-save ---
-@with_db
-async def detect_facebook_link(update: Update, context: ContextTypes.DEFAULT_TYPE, *, conn):
-    text = update.message.text or ''
-    urls = re.findall(r"(https?://(?:www\.)?facebook\.com/[^\s]+)", text)
+async def detect_facebook_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (update.message.text or '')[:MAX_SCAN_CHARS]
+    if "facebook.com" not in text:
+        return
+    urls = [m.group(0) for m in itertools.islice(_FB_URL_RE.finditer(text), MAX_URLS_PER_MESSAGE)]
     if not urls:
         return
-    saved = []
-    for url in urls:
-        uid = await try_get_fb_uid_from_url(url)
-        if uid:
-            await save_uid_to_db(update.effective_chat.id, uid, f"Auto from {url}", conn=conn)
-            saved.append(uid)
-    if saved:
-        await update.message.reply_text(f"Tự động lưu UID / Auto-saved UIDs: {', '.join(saved)}")
+    uids = await asyncio.gather(*(try_get_fb_uid_from_url(url, context.bot_data['http']) for url in urls),
+                                return_exceptions=True)
+    now = int(time.time())
+    rows = []
+    for url, uid in zip(urls, uids):
+        if isinstance(uid, Exception):
+            logging.warning(f"UID lookup failed for {url}: {uid}")
+        elif uid:
+            rows.append((uid, f"Auto from {url}", update.effective_chat.id, now))
+    if rows:
+        await save_uids_to_db(rows)
+        await update.message.reply_text(f"Tự động lưu UID / Auto-saved UIDs: {', '.join(r[0] for r in rows)}")
 
 # --- layanh/checkinfo via Graph API if token provided ---
-async def try_get_fb_profile(uid: str):
+@ttl_cache()
+async def try_get_fb_profile(uid: str, sess: aiohttp.ClientSession):
     if not FB_ACCESS_TOKEN:
         return None
     url = f"https://graph.facebook.com/{uid}"
     params = {"access_token": FB_ACCESS_TOKEN, "fields": "id,name,picture.width(800).height(800),cover"}
-    async with aiohttp.ClientSession() as sess:
-        try:
-            async with sess.get(url, params=params, timeout=10) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-        except Exception:
-            return None
+    try:
+        async with sess.get(url, params=params, timeout=FB_TIMEOUT) as resp:
+            if resp.status == 200:
+                return await resp.json()
+    except Exception:
+        return None
     return None
 
 async def cmd_layanh(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -275,7 +390,7 @@ async def cmd_layanh(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Dùng: /layanh <uid> / Use: /layanh <uid>")
         return
     uid = args[0]
-    info = await try_get_fb_profile(uid)
+    info = await try_get_fb_profile(uid, context.bot_data['http'])
     if info and 'picture' in info and 'data' in info['picture'] and info['picture']['data'].get('url'):
         await update.message.reply_text(f"Name: {info.get('name')}")
         await update.message.reply_photo(photo=info['picture']['data']['url'])
@@ -289,7 +404,7 @@ async def cmd_checkinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Dùng: /checkinfo <uid> / Use: /checkinfo <uid>")
         return
     uid = args[0]
-    info = await try_get_fb_profile(uid)
+    info = await try_get_fb_profile(uid, context.bot_data['http'])
     if not info:
         await update.message.reply_text("Không có thông tin (cần FB_ACCESS_TOKEN) / No info (FB_ACCESS_TOKEN needed)")
         return
@@ -321,21 +436,43 @@ def main():
         entry_points=[CommandHandler('save', cmd_save)],
         states={SAVE_SINGLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_save_single)]},
         fallbacks=[CommandHandler('cancel', cmd_cancel)],
-        per_chat=True
+        per_chat=True,
+        conversation_timeout=300  # drop abandoned /save states instead of keeping them forever
     )
     app.add_handler(conv_save)
 
     # auto-detect FB links
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, detect_facebook_link))
 
-    import asyncio
     async def run():
         await init_db()
-        await app.initialize()
-        await app.start()
-        await app.updater.start_polling()
-        print('Bot started')
-        await app.updater.idle()
+        # one keep-alive pool for all Graph API calls, shared via bot_data
+        http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32, limit_per_host=8, ttl_dns_cache=300,
+                                                                       keepalive_timeout=60))
+        app.bot_data['http'] = http
+        try:
+            await app.initialize()
+            await app.start()
+            if WEBHOOK_HOST:
+                await app.updater.start_webhook(listen='0.0.0.0', port=WEBHOOK_PORT, url_path=TELEGRAM_TOKEN,
+                                                webhook_url=f"https://{WEBHOOK_HOST}/{TELEGRAM_TOKEN}")
+            else:
+                await app.updater.start_polling()
+            print('Bot started')
+            await asyncio.Event().wait()  # run until cancelled (Ctrl+C)
+        finally:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+            await http.close()
+            await POOL.close()
+    try:
+        import uvloop  # optional, not available on Windows
+        uvloop.install()
+    except ImportError:
+        pass
     try:
         asyncio.run(run())
     except (KeyboardInterrupt, SystemExit):